@@ -1,10 +1,28 @@
 import streamlit as st
 import requests
+import numpy as np
+import orjson
 import pandas as pd
 import altair as alt
 import os
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from streamlit.errors import StreamlitSecretNotFoundError
 
+# 데이터와 무관한 차트 설정은 재실행마다 다시 만들지 않도록 모듈 로드 시 한 번만 생성
+CHART_COLS = ("기준MAX", "수주설계", "조업실적")
+COLOR_SCALE = alt.Scale(
+    domain=list(CHART_COLS),
+    range=["#1f77b4", "#2ca02c", "#ff7f0e"],
+)
+TOOLTIP = [
+    alt.Tooltip("date:T", title="날짜", format="%Y-%m-%d"),
+    alt.Tooltip("지표:N", title="지표"),
+    alt.Tooltip("평균값:Q", title="평균값", format=".2f"),
+]
+
+
+@st.cache_resource(show_spinner=False)
 def load_local_env(path=".env"):
     if not os.path.exists(path):
         return
@@ -33,123 +51,135 @@ def read_secret(name: str):
         return None
 
 
-def extract_date_value(props):
-    # 1) 기존 키 우선
-    date_prop = props.get("date")
-    if isinstance(date_prop, dict) and date_prop.get("type") == "date":
-        date_obj = date_prop.get("date")
-        if date_obj:
-            return date_obj.get("start")
+def find_date_keys(props):
+    # 1) 기존 키 우선, 2) Notion 속성 중 type=date 인 필드를 순서대로
+    keys = [name for name, prop in props.items() if isinstance(prop, dict) and prop.get("type") == "date"]
+    if "date" in keys:
+        keys.remove("date")
+        keys.insert(0, "date")
+    return keys
 
-    # 2) Notion 속성 중 type=date 인 첫 필드 자동 탐색
-    for prop in props.values():
-        if isinstance(prop, dict) and prop.get("type") == "date":
-            date_obj = prop.get("date")
-            if date_obj:
-                return date_obj.get("start")
-    return None
 
+def extract_dates(items):
+    # 데이터베이스 스키마는 행마다 같으므로 date 속성 키는 첫 행에서 한 번만 탐색
+    date_keys = None
+    dates = []
+    for item in items:
+        props = item.get("properties", {})
+        if date_keys is None:
+            date_keys = find_date_keys(props)
 
-def fetch_notion_rows(headers, database_id):
-    url = f"https://api.notion.com/v1/databases/{database_id}/query"
-    try:
-        res = requests.post(url, headers=headers, json={"page_size": 100}, timeout=30)
-    except requests.RequestException as e:
-        st.error(f"Notion API 연결 실패: {e}")
-        return None
-
-    try:
-        payload = res.json()
-    except ValueError:
-        st.error(f"Notion API 응답(JSON 아님): HTTP {res.status_code}")
-        st.text(res.text[:500])
-        return None
-
-    if res.status_code != 200:
-        st.error(f"Notion API 오류: HTTP {res.status_code}")
-        st.json(payload)
-        return None
+        value = None
+        for key in date_keys:
+            date_obj = (props.get(key) or {}).get("date")
+            if date_obj:
+                value = date_obj.get("start")
+                break
+        dates.append(value)
+    return dates
 
-    data = payload.get("results")
-    if data is None:
-        st.error("응답에 results 필드가 없습니다.")
-        st.json(payload)
-        return None
 
-    rows = []
-    for item in data:
-        props = item.get("properties", {})
-        date_value = extract_date_value(props)
+@st.cache_resource(show_spinner=False)
+def get_session():
+    # 재실행 간 TLS 연결을 재사용하고, 429/5xx 응답은 백오프 후 재시도
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount("https://", adapter)
+    session.headers.update(
+        {
+            "Notion-Version": "2022-06-28",
+            "Content-Type": "application/json",
+        }
+    )
+    return session
 
-        rows.append(
-            {
-                "date": date_value,
-                "기준MAX": (props.get("기준MAX") or {}).get("number"),
-                "수주설계": (props.get("수주설계") or {}).get("number"),
-                "조업실적": (props.get("조업실적") or {}).get("number"),
-            }
-        )
-    return rows
 
+class NotionFetchError(Exception):
+    # detail: 화면에 함께 표시할 응답 본문 (dict는 st.json, str은 st.text)
+    def __init__(self, message, detail=None):
+        super().__init__(message)
+        self.detail = detail
 
-def main():
-    load_local_env(".env")
-    notion_token = read_secret("NOTION_TOKEN")
-    database_id = read_secret("DATABASE_ID")
 
-    st.markdown("### 연연주비 Dashboard")
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_notion_df(notion_token: str, database_id: str):
+    # 실패는 예외로 알려 캐시되지 않도록 하고, 화면 표시는 호출 측에서 처리
+    url = f"https://api.notion.com/v1/databases/{database_id}/query"
+    headers = {"Authorization": f"Bearer {notion_token}"}
+    session = get_session()
+    body = {"page_size": 100}
+    data = []
+    while True:
+        try:
+            res = session.post(url, headers=headers, json=body, timeout=30)
+        except requests.RequestException as e:
+            raise NotionFetchError(f"Notion API 연결 실패: {e}") from e
 
-    if not notion_token or not database_id:
-        st.error("환경변수가 없습니다: NOTION_TOKEN, DATABASE_ID")
-        st.info("로컬 실행 전 `export NOTION_TOKEN=...`와 `export DATABASE_ID=...`를 설정하거나 `.streamlit/secrets.toml`을 사용하세요.")
-        return
+        try:
+            payload = orjson.loads(res.content)
+        except orjson.JSONDecodeError as e:
+            raise NotionFetchError(f"Notion API 응답(JSON 아님): HTTP {res.status_code}", res.text[:500]) from e
 
-    headers = {
-        "Authorization": f"Bearer {notion_token}",
-        "Notion-Version": "2022-06-28",
-        "Content-Type": "application/json",
-    }
+        if res.status_code != 200:
+            raise NotionFetchError(f"Notion API 오류: HTTP {res.status_code}", payload)
 
-    rows = fetch_notion_rows(headers, database_id)
-    if rows is None:
-        return
+        results = payload.get("results")
+        if results is None:
+            raise NotionFetchError("응답에 results 필드가 없습니다.", payload)
+        data.extend(results)
 
-    df = pd.DataFrame(rows)
-    if df.empty:
-        st.warning("조회된 데이터가 없습니다.")
-        return
+        # 100건 초과 데이터베이스는 next_cursor로 다음 페이지 조회
+        next_cursor = payload.get("next_cursor")
+        if not payload.get("has_more") or not next_cursor:
+            break
+        body["start_cursor"] = next_cursor
 
-    if "date" not in df.columns:
-        st.warning("date 컬럼이 없습니다. Notion의 날짜 속성(type=date)을 확인하세요.")
-        st.dataframe(df.head(5))
-        return
+    # 컬럼별 리스트로 모아 DataFrame 생성 시 행 단위 dict 해싱/타입 추론을 생략
+    dates = extract_dates(data)
+    kmax, design, actual = [], [], []
+    for item in data:
+        props = item.get("properties", {})
+        kmax.append((props.get("기준MAX") or {}).get("number"))
+        design.append((props.get("수주설계") or {}).get("number"))
+        actual.append((props.get("조업실적") or {}).get("number"))
 
-    raw_date_count = df["date"].notna().sum()
-    df["date"] = pd.to_datetime(df["date"], errors="coerce")
+    raw_date_count = sum(value is not None for value in dates)
+    df = pd.DataFrame(
+        {
+            # 같은 속성에 날짜만("2024-01-01")과 시간대 포함 값("...T09:00:00.000+09:00")이 섞일 수 있어
+            # 입력된 날짜(YYYY-MM-DD)만 남겨 고정 형식으로 파싱, 중복 날짜는 캐시
+            "date": pd.to_datetime(
+                [value[:10] if value else None for value in dates],
+                errors="coerce",
+                format="%Y-%m-%d",
+                cache=True,
+            ),
+            "기준MAX": np.array(kmax, dtype="float64"),
+            "수주설계": np.array(design, dtype="float64"),
+            "조업실적": np.array(actual, dtype="float64"),
+        }
+    )
     df = df.dropna(subset=["date"]).sort_values("date")
-    if df.empty:
-        st.warning("유효한 date 데이터가 없어 그래프를 표시할 수 없습니다. (날짜 원본 값 개수: %d)" % raw_date_count)
-        return
+    return df, len(data), raw_date_count
 
-    chart_cols = ["기준MAX", "수주설계", "조업실적"]
-    daily_avg_df = (
-        df.groupby("date", as_index=False)[chart_cols]
-        .mean(numeric_only=True)
-        .sort_values("date")
-    )
+
+@st.cache_data(show_spinner=False)
+def build_chart(daily_avg_df: pd.DataFrame):
+    # 데이터가 같으면 Altair 객체 생성/스키마 검증 없이 캐시된 Vega-Lite 스펙 재사용
     x_domain = [
         daily_avg_df["date"].min() - pd.Timedelta(days=1),
         daily_avg_df["date"].max() + pd.Timedelta(days=1),
     ]
 
-    plot_df = daily_avg_df.melt(id_vars="date", value_vars=chart_cols, var_name="지표", value_name="평균값")
-
-    color_scale = alt.Scale(
-        domain=["기준MAX", "수주설계", "조업실적"],
-        range=["#1f77b4", "#2ca02c", "#ff7f0e"],
-    )
-
-    base = alt.Chart(plot_df).encode(
+    # melt 대신 Vega-Lite fold 변환으로 브라우저에서 long 포맷으로 변환 (스펙에는 wide 데이터만 포함)
+    base = alt.Chart(daily_avg_df).transform_fold(list(CHART_COLS), as_=["지표", "평균값"]).encode(
         x=alt.X(
             "date:T",
             title="날짜",
@@ -160,14 +190,10 @@ def main():
         color=alt.Color(
             "지표:N",
             title="지표",
-            scale=color_scale,
+            scale=COLOR_SCALE,
             legend=alt.Legend(orient="bottom"),
         ),
-        tooltip=[
-            alt.Tooltip("date:T", title="날짜", format="%Y-%m-%d"),
-            alt.Tooltip("지표:N", title="지표"),
-            alt.Tooltip("평균값:Q", title="평균값", format=".2f"),
-        ],
+        tooltip=TOOLTIP,
     )
 
     line_layer = base.mark_line(strokeWidth=3, interpolate="monotone")
@@ -178,10 +204,68 @@ def main():
         fontWeight="bold",
     ).encode(text=alt.Text("평균값:Q", format=".1f"))
 
-    st.altair_chart(
-        (line_layer + point_layer + label_layer).properties(height=420).interactive(),
-        use_container_width=True,
+    chart = (line_layer + point_layer + label_layer).properties(height=420).interactive()
+    # st.altair_chart를 거치지 않으므로 Altair 기본 5000행 제한과 기본 테마(view 크기) 설정을 직접 해제
+    with alt.data_transformers.disable_max_rows(), alt.theme.enable("none"):
+        return chart.to_dict()
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_data(notion_token: str, database_id: str):
+    # 조회와 일자별 집계를 함께 캐시해 재실행 시 resample도 건너뜀
+    # 조회 실패는 NotionFetchError로 전파되어 캐시되지 않고, 경고 문구는 반환값으로 전달
+    df, row_count, raw_date_count = fetch_notion_df(notion_token, database_id)
+    if row_count == 0:
+        return None, "조회된 데이터가 없습니다."
+    if df.empty:
+        return None, "유효한 date 데이터가 없어 그래프를 표시할 수 없습니다. (날짜 원본 값 개수: %d)" % raw_date_count
+
+    # 정렬된 datetime 키이므로 해시 기반 groupby 대신 일 단위 resample 경로 사용
+    # - 시간이 포함된 날짜도 같은 날짜(달력 기준)로 묶어 평균
+    # - resample이 채운 빈 날짜와 지표가 모두 비어 있는 날짜는 dropna(how="all")로 제외
+    daily_avg_df = (
+        df.set_index("date")[list(CHART_COLS)]
+        .resample("D")
+        .mean()
+        .dropna(how="all")
+        .reset_index()
     )
+    if daily_avg_df.empty:
+        return None, "지표 값이 있는 날짜가 없어 그래프를 표시할 수 없습니다."
+    return daily_avg_df, None
+
+
+def main():
+    load_local_env(".env")
+    notion_token = read_secret("NOTION_TOKEN")
+    database_id = read_secret("DATABASE_ID")
+
+    st.markdown("### 연연주비 Dashboard")
+    if st.button("새로고침"):
+        fetch_notion_df.clear()
+        load_data.clear()
+
+    if not notion_token or not database_id:
+        st.error("환경변수가 없습니다: NOTION_TOKEN, DATABASE_ID")
+        st.info("로컬 실행 전 `export NOTION_TOKEN=...`와 `export DATABASE_ID=...`를 설정하거나 `.streamlit/secrets.toml`을 사용하세요.")
+        return
+
+    try:
+        daily_avg_df, warning = load_data(notion_token, database_id)
+    except NotionFetchError as e:
+        st.error(str(e))
+        if isinstance(e.detail, dict):
+            st.json(e.detail)
+        elif e.detail:
+            st.text(e.detail)
+        return
+
+    if warning:
+        st.warning(warning)
+        return
+
+    spec = build_chart(daily_avg_df)
+    st.vega_lite_chart(spec, use_container_width=True)
 
 
 main()